@@ -8,7 +8,19 @@ import subprocess
 import contextlib
 import dataclasses
 import shutil
-from pathlib import PurePath, Path
+import hashlib
+import pickle
+import functools
+import shlex
+import itertools
+import concurrent.futures
+from pathlib import Path
+
+
+COPY_BUFSIZE = 1 << 20
+ADBFS_OPTIONS = ('max_readahead=1048576', 'max_background=64', 'attr_timeout=600', 'entry_timeout=600', 'kernel_cache')
+ADBFS_FUSE2_OPTIONS = ('big_writes',)
+ADB_COMMAND_LIMIT = 64 * 1024
 
 
 @contextlib.contextmanager
@@ -16,52 +28,125 @@ def mount_phone():
     with tempfile.TemporaryDirectory() as mount_dir:
         try:
             print("Mounting phone")
-            subprocess.run(('adbfs', mount_dir), check=True)
+            for options in (ADBFS_FUSE2_OPTIONS + ADBFS_OPTIONS, ADBFS_OPTIONS):
+                if subprocess.run(('adbfs', '-o', ','.join(options), mount_dir), stderr=subprocess.DEVNULL).returncode == 0:
+                    break
+            else:
+                print("adbfs rejected mount options, mounting with defaults")
+                subprocess.run(('adbfs', mount_dir), check=True)
             yield Path(mount_dir)
         finally:
             print("Unmounting phone")
             subprocess.run(('fusermount', '-u', mount_dir))
 
 
+def copy_to_remote(local_path: str, remote_path: str):
+    with open(local_path, 'rb', buffering=0) as r, open(remote_path, 'wb', buffering=0) as w:
+        shutil.copyfileobj(r, w, length=COPY_BUFSIZE)
+
+
+def stat_fields(entry: os.DirEntry):
+    st = entry.stat()
+    return dict(local_mtime_ns=st.st_mtime_ns, local_size=st.st_size)
+
+
 @dataclasses.dataclass
 class File:
-    local_path: Path
-    remote_path: Path
+    local_path: str
+    remote_path: str
+    local_mtime_ns: int
+    local_size: int
 
     def convert(self):
-        shutil.copyfile(self.local_path, self.remote_path)
+        copy_to_remote(self.local_path, self.remote_path)
 
 
 class OpusConvertFile(File):
-    def convert(self):
+    ENCODE_ARGS = ('-vn', '-c:a', 'libopus', '-b:a', '70k')
+
+    def audio_hash(self) -> str:
+        # STREAMINFO is always the first metadata block and ends with the MD5 of the decoded audio
+        with open(self.local_path, 'rb') as f:
+            header = f.read(42)
+        if header[:4] == b'fLaC' and header[26:42].strip(b'\0'):
+            audio_md5 = header[26:42].hex()
+        else:
+            audio_md5 = subprocess.run(
+                ('ffmpeg', '-nostdin', '-v', 'error', '-i', self.local_path, '-map', '0:a', '-f', 'md5', '-'),
+                stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, check=True, encoding='utf8',
+            ).stdout.strip()
+        return hashlib.md5(' '.join((audio_md5, *self.ENCODE_ARGS)).encode()).hexdigest()
+
+    def encode(self, path: str):
         subprocess.run((
-            'ffmpeg', '-y',
+            'ffmpeg', '-nostdin', '-v', 'error', '-y',
             '-i', self.local_path,
-            '-vn', '-c:a', 'libopus',
-            '-b:a', '70k',
-            self.remote_path,
-        ), check=True)
+            *self.ENCODE_ARGS,
+            '-f', 'ogg', path,
+        ), stdin=subprocess.DEVNULL, check=True)
+
+    def encode_cached(self, cache_dir: Path) -> str:
+        key = self.audio_hash()
+        cached_path = cache_dir / f'{key}.ogg'
+        if not cached_path.exists():
+            with tempfile.NamedTemporaryFile(dir=cache_dir, suffix='.ogg', delete=False) as f:
+                pass
+            self.encode(f.name)
+            os.replace(f.name, cached_path)
+        return key
+
+    def convert_from(self, cached_path: Path):
+        args = (
+            'ffmpeg', '-nostdin', '-v', 'error',
+            '-i', cached_path, '-i', self.local_path,
+            '-map', '0:a', '-map_metadata:g', '1:g', '-map_metadata:s:a', '1:g', '-c', 'copy',
+            '-f', 'ogg', 'pipe:1',
+        )
+        with subprocess.Popen(args, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE) as proc:
+            with open(self.remote_path, 'wb', buffering=0) as f:
+                shutil.copyfileobj(proc.stdout, f, length=COPY_BUFSIZE)
+        if proc.returncode:
+            raise subprocess.CalledProcessError(proc.returncode, args)
+
+
+@functools.lru_cache
+def playlist_prefix(local_root: str, playlist_dir: str):
+    return os.path.relpath(local_root, playlist_dir) + '/'
 
 
 @dataclasses.dataclass
 class M3uConvertFile(File):
-    LOCAL_ROOT: Path
+    LOCAL_ROOT: str
 
     def convert(self):
-        prefix = os.path.relpath(self.LOCAL_ROOT, self.local_path.parent) + '/'
-        for char in r'\/&':
-            prefix = prefix.replace(char, f'\\{char}')
+        prefix = os.fsencode(playlist_prefix(self.LOCAL_ROOT, os.path.dirname(self.local_path)))
 
-        with open(self.remote_path, 'w') as f:
-            subprocess.run((
-                'sed', '-e', rf's/^/{prefix}/g', '-e', r's/\.flac/\.ogg/g', self.local_path
-            ), check=True, stdout=f)
+        with open(self.local_path, 'rb') as fin, open(self.remote_path, 'wb') as fout:
+            for line in fin:
+                fout.write(prefix + line.replace(b'.flac', b'.ogg'))
 
 
 @dataclasses.dataclass
 class Dir:
-    local_path: Path
-    remote_path: Path
+    local_path: str
+    remote_path: str
+
+
+class SyncCache:
+    def __init__(self, path: Path):
+        self.path = path
+        try:
+            with open(path, 'rb') as f:
+                self.entries, self.encoded = pickle.load(f)
+        except FileNotFoundError:
+            self.entries = {}
+            self.encoded = {}
+
+    def save(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with tempfile.NamedTemporaryFile(dir=self.path.parent, delete=False) as f:
+            pickle.dump((self.entries, self.encoded), f)
+        os.replace(f.name, self.path)
 
 
 class Sync:
@@ -76,70 +161,106 @@ class Sync:
     def get_filter_set(self, adb_device: str):
         with open(self.LOCAL_PLAYLISTS_ROOT / f"Sync to {adb_device}.m3u") as f:
             LOCAL_ROOT = self.LOCAL_ROOT
-            return {LOCAL_ROOT/p for p in f.read().splitlines()}
+            return frozenset(str(LOCAL_ROOT/p) for p in f.read().splitlines())
 
-    def scan_local(self, local_dir: Path, filter_set: set[Path]):
+    def scan_local_dir(self, local_dir: str, filter_set: frozenset[str]):
+        files = []
         images = []
-
-        def get_inner_files():
-            with os.scandir(local_dir) as it:
-                for entry in it:
-                    entry = Path(entry)
-                    if entry.is_file():
-                        if entry.suffix == '.m3u':
-                            yield M3uConvertFile(
-                                local_path=entry,
-                                remote_path=self.convert_path_local_to_remote(entry),
-                                LOCAL_ROOT=self.LOCAL_ROOT,
-                            )
-                        elif entry in filter_set:
-                            if entry.suffix == '.flac':
-                                yield OpusConvertFile(
-                                    local_path=entry,
-                                    remote_path=self.convert_path_local_to_remote(entry).with_suffix('.ogg'),
-                                )
-                            else:
-                                yield File(
-                                    local_path=entry,
-                                    remote_path=self.convert_path_local_to_remote(entry),
-                                )
-                        elif entry.suffix in {'.jpg', '.jpeg', '.png', '.JPG', '.JPEG', '.PNG'} and entry.stem == 'cover':
-                            images.append(File(
-                                local_path=entry,
-                                remote_path=self.convert_path_local_to_remote(entry),
+        subdirs = []
+        remote_dir = str(self.convert_path_local_to_remote(Path(local_dir)))
+        LOCAL_ROOT = str(self.LOCAL_ROOT)
+
+        with os.scandir(local_dir) as it:
+            for entry in it:
+                if entry.is_file():
+                    stem, suffix = os.path.splitext(entry.name)
+                    remote_path = os.path.join(remote_dir, entry.name)
+                    if suffix == '.m3u':
+                        files.append(M3uConvertFile(
+                            local_path=entry.path,
+                            remote_path=remote_path,
+                            **stat_fields(entry),
+                            LOCAL_ROOT=LOCAL_ROOT,
+                        ))
+                    elif entry.path in filter_set:
+                        if suffix == '.flac':
+                            files.append(OpusConvertFile(
+                                local_path=entry.path,
+                                remote_path=os.path.join(remote_dir, stem + '.ogg'),
+                                **stat_fields(entry),
                             ))
-                    elif entry.is_dir():
-                        if entry.name == '.mediaartlocal':
-                            continue
-                        yield from self.scan_local(entry, filter_set)
-                    else:
-                        raise AssertionError("entry is neither file nor directory")
-
-        inner_files = get_inner_files()
-        try:
-            f = next(inner_files)
-        except StopIteration:
-            return
-
-        yield Dir(
-            local_path=local_dir,
-            remote_path=self.convert_path_local_to_remote(local_dir),
-        )
-        yield f
-        yield from inner_files
-        yield from images
-
-    def scan_remote(self, mount_dir: Path, relative_path: Path):
-        remote_starting_point = str(PurePath('/') / relative_path)
-        proc = subprocess.run(
-            ('adb', 'shell', rf'find {remote_starting_point} -print0 | xargs -0 stat -c "%Y %n"'),
-            capture_output=True, check=True, encoding='utf8',
-        )
+                        else:
+                            files.append(File(
+                                local_path=entry.path,
+                                remote_path=remote_path,
+                                **stat_fields(entry),
+                            ))
+                    elif suffix in {'.jpg', '.jpeg', '.png', '.JPG', '.JPEG', '.PNG'} and stem == 'cover':
+                        images.append(File(
+                            local_path=entry.path,
+                            remote_path=remote_path,
+                            **stat_fields(entry),
+                        ))
+                elif entry.is_dir():
+                    if entry.name == '.mediaartlocal':
+                        continue
+                    subdirs.append(entry.path)
+                else:
+                    raise AssertionError("entry is neither file nor directory")
+
+        return Dir(local_path=local_dir, remote_path=remote_dir), files, images, subdirs
+
+    def scan_local(self, local_root: str, filter_set: frozenset[str]):
+        scanned = {}
+        with concurrent.futures.ThreadPoolExecutor(max_workers=16) as executor:
+            pending = {executor.submit(self.scan_local_dir, local_root, filter_set)}
+            while pending:
+                done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    d, files, images, subdirs = future.result()
+                    scanned[d.local_path] = d, files, images, subdirs
+                    pending |= {executor.submit(self.scan_local_dir, subdir, filter_set) for subdir in subdirs}
+
+        def collect(local_dir: str):
+            d, files, images, subdirs = scanned[local_dir]
+            contents = list(files)
+            for subdir in subdirs:
+                contents.extend(collect(subdir))
+            if not contents:
+                return []
+            return [d, *contents, *images]
+
+        yield from collect(local_root)
+
+    def start_remote_scan(self, relative_path: Path) -> subprocess.Popen:
+        remote_starting_point = '/' + str(relative_path)
+        command = rf'find {remote_starting_point} -printf "%T@ %y %p\\0"'
+        if not self.args.dry_run:
+            print("Removing thumbnails")
+            command = f'rm -rf {remote_starting_point}/.thumbnails && {command}'
 
-        for line in proc.stdout.splitlines():
-            mtime, filepath = line.split(maxsplit=1)
-            filepath = mount_dir / PurePath(filepath).relative_to('/')
-            yield filepath, float(mtime)
+        print("Scanning remote")
+        return subprocess.Popen(('adb', 'shell', command), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+    def scan_remote(self, proc: subprocess.Popen, mount_dir: Path) -> tuple[dict[str, int], set[str]]:
+        mount_prefix = str(mount_dir)
+        stdout, stderr = proc.communicate()
+        if proc.returncode:
+            raise subprocess.CalledProcessError(proc.returncode, proc.args, stdout, stderr)
+
+        remote_file_mtimes = {}
+        remote_dirs = set()
+        for record in stdout.split(b'\0'):
+            if not record:
+                continue
+            mtime, _, record = record.partition(b' ')
+            filetype, _, filepath = record.partition(b' ')
+            filepath = mount_prefix + filepath.decode()
+            seconds, _, fraction = mtime.partition(b'.')
+            remote_file_mtimes[filepath] = int(seconds) * 10**9 + int(fraction[:9].ljust(9, b'0'))
+            if filetype == b'd':
+                remote_dirs.add(filepath)
+        return remote_file_mtimes, remote_dirs
 
     def __init__(self, args, mount_dir, adb_device):
         self.args = args
@@ -147,50 +268,132 @@ class Sync:
         self.REMOTE_ROOT = mount_dir / 'sdcard' / 'Music'
         self.LOCAL_ROOT = Path.home() / 'Music'
         self.LOCAL_PLAYLISTS_ROOT = self.LOCAL_ROOT / '.playlists'
+        self.CACHE_DIR = Path.home() / '.cache' / 'music_sync' / adb_device
+        self.OPUS_CACHE_DIR = self.CACHE_DIR / 'opus'
+        self.cache = SyncCache(self.CACHE_DIR / 'sync.pickle')
 
-        filter_set = self.get_filter_set(adb_device)
-        self.local_collection = list(self.scan_local(self.LOCAL_ROOT, filter_set))
+        self.remote_proc = self.start_remote_scan(self.REMOTE_ROOT.relative_to(self.MOUNT_DIR))
+        self.remote_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self.remote_scan = self.remote_executor.submit(self.scan_remote, self.remote_proc, self.MOUNT_DIR)
 
-    def sync(self):
-        if not self.args.dry_run:
-            print("Removing thumbnails")
-            subprocess.run(
-                ('adb', 'shell', 'rm -rf {}'.format(Path('/')/self.REMOTE_ROOT.relative_to(self.MOUNT_DIR)/'.thumbnails')),
-                check=True,
-            )
+        try:
+            filter_set = self.get_filter_set(adb_device)
+            self.local_collection = list(self.scan_local(str(self.LOCAL_ROOT), filter_set))
+        except BaseException:
+            self.remote_executor.shutdown(wait=False, cancel_futures=True)
+            self.remote_proc.kill()
+            raise
+        self.local_remote_paths = frozenset(f.remote_path for f in self.local_collection)
 
-        print("Scanning remote")
-        remote_file_mtimes = dict(self.scan_remote(self.MOUNT_DIR, self.REMOTE_ROOT.relative_to(self.MOUNT_DIR)))
+    def sync(self):
+        remote_file_mtimes, remote_dirs = self.remote_scan.result()
+        self.remote_executor.shutdown()
 
-        to_delete = sorted((set(remote_file_mtimes) - {p.remote_path for p in self.local_collection}), reverse=True)
+        stale = remote_file_mtimes.keys() - self.local_remote_paths
+        stale_dirs = stale & remote_dirs
+        to_delete = sorted(stale, key=len, reverse=True)
         for f in to_delete:
             print(f"Deleting {f}")
-            if not self.args.dry_run:
-                if f.is_dir():
-                    f.rmdir()
-                else:
-                    f.unlink()
-
+        if not self.args.dry_run:
+            mount_prefix_len = len(str(self.MOUNT_DIR))
+            device_paths = [
+                shlex.quote(f[mount_prefix_len:]) for f in to_delete
+                if os.path.dirname(f) not in stale_dirs
+            ]
+            command = ('rm', '-rf', '--')
+            chunk = []
+            chunk_len = len(' '.join(command))
+            for path in device_paths:
+                if chunk and chunk_len + 1 + len(path.encode()) > ADB_COMMAND_LIMIT:
+                    subprocess.run(('adb', 'shell', *command, *chunk), check=True)
+                    chunk = []
+                    chunk_len = len(' '.join(command))
+                chunk.append(path)
+                chunk_len += 1 + len(path.encode())
+            if chunk:
+                subprocess.run(('adb', 'shell', *command, *chunk), check=True)
+
+        to_encode = []
+        to_copy = []
+        cache_entries = {}
+        encoded_keys = {}
         for f in self.local_collection:
-            remote_mtime = remote_file_mtimes.get(f.remote_path)
-            if (
-                remote_mtime is None
-                or f.local_path.is_file() and remote_mtime < f.local_path.stat().st_mtime
-            ):
-                if isinstance(f, Dir):
+            if isinstance(f, Dir):
+                if f.remote_path not in remote_dirs:
                     print(f"Creating directory {f.remote_path}")
                     if not self.args.dry_run:
-                        f.remote_path.mkdir()
+                        os.mkdir(f.remote_path)
+                continue
+
+            remote_mtime_ns = remote_file_mtimes.get(f.remote_path)
+            state = f.local_size, f.local_mtime_ns
+            if (
+                remote_mtime_ns is None
+                or self.cache.entries.get(f.local_path) != state and remote_mtime_ns < f.local_mtime_ns
+            ):
+                if isinstance(f, OpusConvertFile):
+                    to_encode.append(f)
                 else:
                     assert isinstance(f, File)
+                    to_copy.append(f)
+            else:
+                cache_entries[f.local_path] = state
+                if f.local_path in self.cache.encoded:
+                    encoded_keys[f.local_path] = self.cache.encoded[f.local_path]
+                # print(f"Skipping {f.remote_path}")
+
+        if not self.args.dry_run:
+            self.OPUS_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+
+        for f in to_encode:
+            print(f"Syncing {f.remote_path}")
+        if self.args.dry_run:
+            to_encode = []
+
+        max_workers = os.cpu_count()
+        with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as executor:
+            pending = iter(to_encode)
+            encoding = {}
+
+            def submit(count: int):
+                for f in itertools.islice(pending, count):
+                    encoding[executor.submit(f.encode_cached, self.OPUS_CACHE_DIR)] = f
+
+            def drain(timeout: typing.Optional[float]):
+                done, _ = concurrent.futures.wait(encoding, timeout=timeout, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    f = encoding.pop(future)
+                    key = future.result()
+                    f.convert_from(self.OPUS_CACHE_DIR / f'{key}.ogg')
+                    encoded_keys[f.local_path] = key
+                    cache_entries[f.local_path] = f.local_size, f.local_mtime_ns
+                submit(len(done))
+
+            try:
+                submit(2 * max_workers)
+
+                for f in to_copy:
                     print(f"Syncing {f.remote_path}")
                     if not self.args.dry_run:
-                        if f.remote_path.exists():
-                            f.remote_path.unlink()
                         f.convert()
-            else:
-                pass
-                # print(f"Skipping {f.remote_path}")
+                        cache_entries[f.local_path] = f.local_size, f.local_mtime_ns
+                    drain(0)
+
+                while encoding:
+                    drain(None)
+            except BaseException:
+                executor.shutdown(cancel_futures=True)
+                raise
+
+        if not self.args.dry_run:
+            self.cache.entries = cache_entries
+            self.cache.encoded = encoded_keys
+            self.cache.save()
+
+            keep = set(encoded_keys.values())
+            for cached_path in self.OPUS_CACHE_DIR.iterdir():
+                if cached_path.stem not in keep:
+                    cached_path.unlink()
 
     @classmethod
     def parse_args(cls):